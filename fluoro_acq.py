@@ -9,22 +9,73 @@ chunk of information
 """
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import (QMainWindow, QGridLayout, QWidget, QApplication, QLabel, 
-                            QComboBox, QPushButton, QLineEdit, QFrame, QCheckBox, QFileDialog)
-from PyQt5.QtCore import QThread, QObject, pyqtSignal
-from PyQt5.QtGui import QFont
+                            QComboBox, QPushButton, QLineEdit, QFrame, QCheckBox, QFileDialog, QGraphicsItem)
+from PyQt5.QtCore import QThread, QObject, QTimer, pyqtSignal
+from PyQt5.QtGui import QFont, QCursor
 import pyqtgraph as pg
+import numpy as np
 import sys 
 import os
-from pyqtgraph import colormap
 import serial
 import serial.tools.list_ports
 import time
-import random
-import statistics
+import threading
+import logging
+
+log = logging.getLogger(__name__)
 
 # Convert the time to a value to send to the detector
 PERIOD_CONVERTER = {'100ms': 10, '200ms': 20, '250ms': 25, '500ms': 50, '1000ms': 100}
 
+# Serial commands sent to the detector. The period command is P followed by the period value 
+# as a single byte, these are built once here for every period option
+PERIOD_COMMANDS = {period: b"P" + bytes([value]) + b"\r" for period, value in PERIOD_CONVERTER.items()}
+HV_ON = b"D\r"
+START_CMD = b"C\r"
+
+# Lookup tables used to decode the detector payload, which is read as the decimal digits of each 
+# byte joined together. The first two bytes are used as is, the third byte is zero padded at the
+# front if it is 2 digits and the fourth byte is always zero padded at the back out to 3 digits
+# Each of these is a numpy array indexed by byte value, so a whole read is decoded in one go
+DIGIT_COUNT = np.array([len(str(b)) for b in range(256)], dtype=np.int64)
+MID_BYTE_WIDTH = np.array([3 if b >= 10 else 1 for b in range(256)], dtype=np.int64)
+LOW_BYTE_VALUE = np.array([int(str(b).ljust(3, '0')) for b in range(256)], dtype=np.int64)
+POWERS_OF_TEN = 10 ** np.arange(13, dtype=np.int64)
+
+# How often (in seconds) the acquisition thread sends newly collected data to the UI thread
+EMIT_INTERVAL = 1 / 30
+
+# How often (in milliseconds) the chart gets redrawn with any new data, ~30 fps
+REDRAW_INTERVAL = 33
+
+# How long (in seconds) to wait for the detector to reply to each setup command
+SETUP_REPLY_TIMEOUT = 1
+
+# Serial read timeout (in seconds) used in the acquisition loop, this is how long a stop can take
+LOOP_READ_TIMEOUT = 0.1
+
+# How often (in milliseconds) the com ports are checked for a detector being plugged in or removed
+PORT_REFRESH_INTERVAL = 1000
+
+# Line written to the save file for each sample (value, time), using bytes formatting so 
+# no strings are made while writing
+CSV_LINE = b"%.1f, %.6f\n"
+
+# The save file is written and flushed to disk once FLUSH_BYTES of lines are waiting or every 
+# FLUSH_INTERVAL seconds, whichever comes first
+FLUSH_BYTES = 4096
+FLUSH_INTERVAL = 1
+
+# Number of points the acquisition thread makes room for to start with, this doubles as needed
+RAW_INITIAL_CAPACITY = 4096
+
+# App wide font (Segoe UI is the windows 10 system font) and stylesheet, these are made once here
+APP_FONT = QFont('Segoe UI')
+APP_STYLE = """ QLabel { font: 14px; } QLineEdit { font: 14px } QComboBox { font: 14px } QPushButton { font: 14px } QCheckBox { font: 14px }"""
+
+# Number of raw data points that are held for the chart before the oldest start getting overwritten
+PLOT_BUFFER_SIZE = 20000
+
 class MainWindow(QMainWindow):
 
     def __init__(self, *args, **kwargs):
@@ -38,16 +89,40 @@ class MainWindow(QMainWindow):
         self.ser = None
         self.measuring = False
         
-        # Lists for the raw data
-        self.plot_x = []
-        self.plot_y = []
+        # Ring buffers for the raw data, once full the oldest points get overwritten. The counts 
+        # are at most 6 digits so they fit exactly in float32, the times need the full float64
+        self.plot_x = RingBuffer(PLOT_BUFFER_SIZE, np.float64)
+        self.plot_y = RingBuffer(PLOT_BUFFER_SIZE, np.float32)
 
         # These are used for creating the 1 second median smoothed chart
         self.st = None
-        self.count_back = 0
+        self.window_count = 0
         self.smooth_plot_x = []
         self.smooth_plot_y = []
 
+        # Set when new data has arrived and the chart lines need redrawing
+        self.raw_dirty = False
+        self.smooth_dirty = False
+
+        # Set when the chart has been panned, zoomed or resized and the raw line needs redrawing.
+        # The right edge of the view and of the drawn raw line are used to skip redrawing when
+        # the new data is off the side of the chart anyway
+        self.view_changed = False
+        self.view_x_max = None
+        self.drawn_x_max = None
+
+        # Set once Auto Track has snapped the chart to the latest data, after that it just slides along
+        self.tracking = False
+
+        # Width of the chart in pixels, the raw data gets downsampled to ~4 points per pixel
+        self.chart_width = 0
+
+        # The com port devices currently listed in the combobox
+        self.known_ports = ()
+
+        # Set once the window has been centered on the screen, so it only happens the first time
+        self.centered = False
+
         # Startup functions
         self.init_ui()
         self.init_ports()
@@ -58,20 +133,14 @@ class MainWindow(QMainWindow):
         widget and then placing them in the relevant locations of the grid layout
         """
         # Set the app wide font as Segoe UI (the windows 10 system font)
-        self.setFont(QFont('Segoe UI'))
-        self.setStyleSheet(""" QLabel { font: 14px; } QLineEdit { font: 14px } QComboBox { font: 14px } QPushButton { font: 14px } QCheckBox { font: 14px }""")
+        self.setFont(APP_FONT)
+        self.setStyleSheet(APP_STYLE)
         # Create the grid layout and set the gutter spacing to 10px
         grid_layout = QGridLayout()
         grid_layout.setSpacing(10)
 
-        # The following 6 lines are used to set the window size and then place it
-        # in the center of the 'active' screen (user could be using a multi monitor setup)
-        self.setGeometry(0, 0, 1400, 550)
-        qtRectangle = self.frameGeometry()
-        screen = QApplication.desktop().screenNumber(QApplication.desktop().cursor().pos())
-        centerPoint = QApplication.desktop().screenGeometry(screen).center()
-        qtRectangle.moveCenter(centerPoint)
-        self.move(qtRectangle.topLeft())
+        # Set the window size, it gets placed in the center of the screen when it is first shown
+        self.resize(1400, 550)
         
         self.setWindowTitle('Fluorometer Logger')
     
@@ -87,7 +156,7 @@ class MainWindow(QMainWindow):
         self.connection_status.setReadOnly(True)
         self.connection_status.setAlignment(QtCore.Qt.AlignCenter)
         self.connection_status.setStyleSheet("QLineEdit { background: rgb(224, 20, 0); color: rgb(250, 250, 250);}")
-        self.connection_status.setFont(QFont('Segoe UI'))
+        self.connection_status.setFont(APP_FONT)
 
         linesep_1 = QFrame()
         linesep_1.setFrameShape(QFrame.HLine)
@@ -115,21 +184,25 @@ class MainWindow(QMainWindow):
 
         measure_freq_label = QLabel('Measure Frequency:')
         self.measure_freq_combo = QComboBox()
-        self.measure_freq_combo.addItems(['100ms', '200ms', '250ms', '500ms', '1000ms'])    
-        self.measure_freq_combo.setEditable(True)
-        self.measure_freq_combo.setEditable(False)
+        # The options come straight from the precomputed period commands, so every option 
+        # shown always has a command to send
+        self.measure_freq_combo.addItems(list(PERIOD_COMMANDS))
         
         self.start_acquire = QPushButton("Acquire Data")
         self.start_acquire.clicked.connect(self.acquire_data)
 
         self.autoscale_chart = QCheckBox("Auto Track")
         self.autoscale_chart.setToolTip('Track new data along X axis')
+        self.autoscale_chart.toggled.connect(self.auto_track_toggled)
 
         self.signal_value = QLineEdit()
         self.signal_value.setReadOnly(True)
         self.signal_value.setFixedWidth(120)
 
-        pg.setConfigOptions(antialias=True)
+        # Use open Gl for slightly better performance, this needs setting before the chart 
+        # widget is made. Antialiasing is left off for the busy raw data line, it is only 
+        # turned on for the smoothed line further down
+        pg.setConfigOptions(useOpenGL=True, antialias=False)
         self.graphWidget = pg.PlotWidget()
         self.graphWidget.setLabel('left', 'Raw Count')
         self.graphWidget.setLabel('bottom', 'Time')
@@ -137,6 +210,13 @@ class MainWindow(QMainWindow):
         self.graphWidget.setBackground('w')
         self.graphWidget.sizePolicy().setHorizontalStretch(3)
 
+        # Let pyqtgraph peak downsample and clip the lines to the view when painting. The raw line 
+        # is already clipped and M4 downsampled to ~4 points per pixel in visible_raw_data (auto 
+        # ranging or not), so this does next to nothing for it, it is here for the smoothed line. 
+        # Set on the plot so it also shows in the chart's right click menu
+        self.graphWidget.setDownsampling(auto=True, mode='peak')
+        self.graphWidget.setClipToView(True)
+
         graph_pen = pg.mkPen(color=(10, 10, 180))
         smooth_graph_pen = pg.mkPen(color=(10, 180, 10))
         
@@ -171,34 +251,90 @@ class MainWindow(QMainWindow):
         grid_layout.addWidget(self.graphWidget, 0, 2, 18, 12)
 
         # Set up our pyqtgraph widget with the 2 plottable lines
-        self.plotted_data = self.graphWidget.plot(self.plot_x, self.plot_y, pen=graph_pen)
-        self.smoothed_plotted_data = self.graphWidget.plot(self.smooth_plot_x, self.smooth_plot_y, pen=smooth_graph_pen)
-        
-        # Use open Gl for slightly better performance
-        self.graphWidget.useOpenGL(True)
+        self.plotted_data = self.graphWidget.plot(*self.raw_data_view(), pen=graph_pen)
+        self.smoothed_plotted_data = self.graphWidget.plot(self.smooth_plot_x, self.smooth_plot_y, pen=smooth_graph_pen, antialias=True)
+
+        for plotted in (self.plotted_data, self.smoothed_plotted_data):
+            # Cache the rendered line so it is only repainted when its data changes (setData 
+            # invalidates the cache), not on every hover or other view event
+            plotted.curve.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+
+        # The chart is redrawn on a timer rather than every time data comes in, so sample rate 
+        # and redraw rate are independent of each other
+        self.redraw_timer = QTimer()
+        self.redraw_timer.timeout.connect(self.redraw_chart)
+        self.redraw_timer.start(REDRAW_INTERVAL)
+
+        # Keep track of the chart size for downsampling, and redraw when the user pans or zooms
+        # because the downsampled data only covers what is in view
+        view_box = self.graphWidget.getViewBox()
+        view_box.sigResized.connect(self.chart_resized)
+        view_box.sigXRangeChanged.connect(self.chart_view_changed)
         
         # Set the layout of the application window widget to the grid layout which is holding everything
         self.centralWidget().setLayout(grid_layout)
 
 
 
+    def showEvent(self, event):
+        """
+        Places the window in the center of the 'active' screen, the one the cursor is on (user 
+        could be using a multi monitor setup). This is done here rather than in init_ui so it 
+        only happens once the window is actually being shown
+        """
+        super().showEvent(event)
+        if not self.centered:
+            screen = QApplication.screenAt(QCursor.pos()) or self.screen()
+            window_rect = self.frameGeometry()
+            window_rect.moveCenter(screen.availableGeometry().center())
+            self.move(window_rect.topLeft())
+            self.centered = True
+
     def init_ports(self):
         """
-        Finds all the available com ports on the system, lists them in the combobox
+        Finds all the available com ports on the system, lists them in the combobox. The ports
+        are then checked again on a timer so a detector plugged in later still shows up
+        """
+        self.refresh_ports()
+
+        self.port_timer = QTimer()
+        self.port_timer.timeout.connect(self.refresh_ports)
+        self.port_timer.start(PORT_REFRESH_INTERVAL)
+
+    def refresh_ports(self):
+        """
+        Compares the com ports on the system to the ones already listed, only the ports that 
+        have been added or removed are changed in the combobox. Nothing is done while connected
         """
+        if self.ser is not None and self.ser.is_open:
+            return
+
         ports = serial.tools.list_ports.comports()
-        for port in ports:
-            self.ports_combo.addItem(str(port)[:15] + "...")
-        
+        devices = tuple(port.device for port in ports)
+        if devices == self.known_ports:
+            return
+
+        for device in set(self.known_ports) - set(devices):
+            self.ports_combo.removeItem(self.ports_combo.findText(device))
+
+        # List the device names (e.g. COM5) all at once, with their descriptions available on hover
+        new_ports = [port for port in ports if port.device not in self.known_ports]
+        first_index = self.ports_combo.count()
+        self.ports_combo.addItems([port.device for port in new_ports])
+        for index, port in enumerate(new_ports, first_index):
+            self.ports_combo.setItemData(index, port.description, QtCore.Qt.ToolTipRole)
+
+        self.known_ports = devices
+
     def toggle_port(self):
         """
         This function is responsible for opening and closing the serial port 
         """
-        port = self.ports_combo.currentText().split(" ")[0]
-        print(port)
+        port = self.ports_combo.currentText()
+        log.debug('Selected port: %s', port)
 
         if self.ser:
-            print("Closing port")
+            log.debug("Closing port")
 
             self.ser.close()
             self.ser = None
@@ -208,7 +344,7 @@ class MainWindow(QMainWindow):
             self.connection_status.setStyleSheet("QLineEdit { background: rgb(224, 20, 0); color: rgb(250, 250, 250);}")
         
         else:
-            print("Opening port")
+            log.debug("Opening port")
             #self.ser = 1
             try:
                 self.ser = serial.Serial(timeout=1, baudrate=9600, stopbits=1, parity=serial.PARITY_NONE)
@@ -219,7 +355,10 @@ class MainWindow(QMainWindow):
                 self.connection_status.setText("CONNECTED")
                 self.connection_status.setStyleSheet("QLineEdit { background: rgb(15, 200, 53); color: rgb(250, 250, 250);}")
             except Exception:
-                print(Exception)    
+                log.exception('Could not open port %s', port)
+                # Don't hold on to the closed port, so it can be tried again and the port list 
+                # keeps refreshing
+                self.ser = None
 
     def browse_file_folder(self):
         """
@@ -240,7 +379,6 @@ class MainWindow(QMainWindow):
         # Get all of the required values from the fields
         folder_path = self.folder_path_lineedit.text()
         current_period = self.measure_freq_combo.currentText()
-        converted_period = PERIOD_CONVERTER[current_period]
         high_voltage = self.high_voltage_checkbox.isChecked()
 
         if not self.measuring:
@@ -249,28 +387,41 @@ class MainWindow(QMainWindow):
                     self.start_acquire.setText("Stop Acquire")
                     self.ser.flushOutput()
 
-                    #Turn on high voltage if ticked
-                    if high_voltage:
-                        self.ser.write(b"D\r")
-                        print(self.ser.read(2))
-                    
-                    #Set the gating period
-                    ascii_period = chr(converted_period)
-                    writable_string = f"P{ascii_period}\r".encode('utf-8')
-                    #self.ser.write(b"P\r")
-                    self.ser.write(writable_string)
-                    print(self.ser.read(2))
-                    print(self.ser.inWaiting())
+                    # Turn on high voltage if ticked and set the gating period. The commands are 
+                    # sent in one write and the detector replies with 2 bytes for each of them, 
+                    # these are all read back in one go allowing SETUP_REPLY_TIMEOUT per command
+                    setup_commands = [HV_ON] if high_voltage else []
+                    setup_commands.append(PERIOD_COMMANDS[current_period])
+                    self.ser.write(b"".join(setup_commands))
+
+                    port_timeout = self.ser.timeout
+                    self.ser.timeout = SETUP_REPLY_TIMEOUT * len(setup_commands)
+                    reply = self.ser.read(2 * len(setup_commands))
+                    self.ser.timeout = port_timeout
+                    log.debug('Setup reply: %s', reply)
+
+                    # A short reply means a late reply could still turn up and throw the data frames 
+                    # out of line, so anything left over is cleared out
+                    if len(reply) != 2 * len(setup_commands):
+                        log.warning('Expected a %s byte reply to the setup commands but got %s', 2 * len(setup_commands), reply)
+                        self.ser.reset_input_buffer()
+                    log.debug('Bytes waiting: %s', self.ser.inWaiting())
                     
                     # Initiate the data acquisition object and start the loop
                     self.measuring = True
                     self.thread = QThread()
-                    self.data_thread = DataAcquirer(self.ser, folder_path)
+                    period_ms = PERIOD_CONVERTER[current_period] * 10
+                    self.data_thread = DataAcquirer(self.ser, folder_path, period_ms)
                     self.data_thread.moveToThread(self.thread)
                     self.thread.started.connect(self.data_thread.data_acquire_loop)
                     self.data_thread.finished.connect(self.thread.quit)
                     self.data_thread.new_data.connect(self.update_chart)
 
+                    # Clean up the thread and acquirer once the loop has properly finished
+                    self.data_thread.finished.connect(self.data_thread.deleteLater)
+                    self.thread.finished.connect(self.thread.deleteLater)
+                    self.thread.finished.connect(self.acquisition_stopped)
+
                     # Disable all of the buttons so that I don't have to add checking to their functions
                     self.connect_button.setEnabled(False)
                     self.browse_path_button.setEnabled(False)
@@ -279,78 +430,181 @@ class MainWindow(QMainWindow):
 
                     self.thread.start()
                 else:
-                    print('Please browse to a folder first')
+                    log.warning('Please browse to a folder first')
             else:
-                print('There is not a current serial connection!')
+                log.warning('There is not a current serial connection!')
         else:
-            # This will stop the data acquisition loop
+            # This will stop the data acquisition loop, it might be part way through a serial 
+            # read but that times out within LOOP_READ_TIMEOUT. The button stays disabled until the thread 
+            # has actually finished
             self.measuring = False
-            self.data_thread.measuring = False
-            
-            # Renable everything when acquisition has stopped
-            self.connect_button.setEnabled(True)
-            self.browse_path_button.setEnabled(True)
-            self.high_voltage_checkbox.setEnabled(True)
-            self.measure_freq_combo.setEnabled(True)
-            
-            self.start_acquire.setText("Start Acquire")
+            self.data_thread.stop_event.set()
+
+            self.start_acquire.setEnabled(False)
+            self.start_acquire.setText("Stopping...")
+
+    def acquisition_stopped(self):
+        """
+        Called once the acquisition thread has finished, only then is it safe to start a new
+        acquisition or close the port
+        """
+        # Renable everything when acquisition has stopped
+        self.connect_button.setEnabled(True)
+        self.browse_path_button.setEnabled(True)
+        self.high_voltage_checkbox.setEnabled(True)
+        self.measure_freq_combo.setEnabled(True)
+        
+        self.start_acquire.setEnabled(True)
+        self.start_acquire.setText("Start Acquire")
 
     def update_chart(self, new_data):
         """
         Class method that will add the newly collected data to the plot,
-        this will also create a median smoothed dataset every 1 second and add it to the chart
+        this will also create a median smoothed dataset every 1 second and add it to the chart.
+        new_data is a numpy array with a [value, time] row for every point the acquisition 
+        thread has collected since it last sent data over
         """
-        # Once we have a lot of data in the lists, start removing points so that the 
-        # app stays performant
-        if len(self.plot_x) == 20000:
-            self.plot_x.pop(0)
-            self.plot_y.pop(0)
-
-        # Add the latest raw data to the raw plot lists
-        self.plot_x.append(new_data[1])
-        self.plot_y.append(new_data[0])
-
-        # st is start time, this is used to create a median smoothed chart
-        if not self.st:
-            self.st = new_data[1]
-
-        # Set the current time to the latest data time point
-        ct = new_data[1]
-
-        # ct is current time, the value 1 represents 1 second. If 1 second has passed
-        # then create a median of the past second worth of data and pass it to the smooth lists
-        if (ct - self.st) > 1:
-            
-            # Pull subset from the raw data with count back var, calc median
-            subset = self.plot_y[-self.count_back:]
-            median = statistics.median(subset)
-
-            # I am making this median value slightly smaller than the raw data so that is 
-            # is offset from the raw data line - improving ledgibility on the chart
-            median = median * 0.99
+        values = new_data[:, 0]
+        times = new_data[:, 1]
+        count = len(new_data)
+
+        # Add the latest raw data to the ring buffers in one go, once full the oldest points 
+        # get overwritten so that the app stays performant
+        self.plot_x.extend(times)
+        self.plot_y.extend(values)
+        plot_y = self.plot_y.view()
+
+        # Work through the new data one 1 second window at a time
+        i = 0
+        while i < count:
+            # st is start time, this is used to create a median smoothed chart. The sample times 
+            # are worked out from the gating period by the acquisition thread, so unlike the wall 
+            # clock they only ever go forwards and the window can't get stuck after a clock change
+            if self.st is None:
+                self.st = times[i]
+
+            # Find the first point that is more than 1 second past the start time (the value 1 
+            # represents 1 second), if there isn't one the window carries on into the next data
+            ct_index = i + np.searchsorted(times[i:], self.st + 1, side='right')
+            if ct_index == count:
+                self.window_count = self.window_count + count - i
+                break
+            self.window_count = self.window_count + ct_index - i + 1
+
+            # ct is current time, 1 second has passed so create a median of the past second 
+            # worth of data and pass it to the smooth lists
+            ct = times[ct_index]
+
+            # Grab the median of the points collected over the past second, straight 
+            # from the ring buffer (the window can't be any bigger than what it holds)
+            window_end = len(plot_y) - (count - ct_index - 1)
+            window_start = max(window_end - self.window_count, 0)
+            median = window_median(plot_y[window_start:window_end])
+
+            # I am drawing the median line slightly below the raw data so that it is offset 
+            # from the raw data line - improving ledgibility on the chart. This is done by 
+            # shifting the whole line down by 1% of the first median, so the stored median 
+            # data itself stays accurate
+            if not self.smooth_plot_y:
+                self.smoothed_plotted_data.setPos(0, -0.01 * median)
             
             # Add the median smoothed data
             self.smooth_plot_x.append(ct)
             self.smooth_plot_y.append(median)
+            self.smooth_dirty = True
+
+            # Reset the start time and the window
+            self.window_count = 0
+            self.st = None
+            i = ct_index + 1
+
+        # Flag the raw chart and signal value for the next redraw
+        self.raw_dirty = True
 
-            # Update the chart with the new data
+    def redraw_chart(self):
+        """
+        Called by the redraw timer, this pushes the latest data to the chart lines and the
+        signal value box, but only if new data has come in since the last redraw
+        """
+        if self.raw_dirty:
+            # Display the latest signal value
+            self.signal_value.setText(f'Signal: {self.plot_y.view()[-1]:.0f}')
+
+            if self.autoscale_chart.isChecked():
+                # This will pan the chart along when there is enough data to do so, it is done 
+                # before setting the data so the downsampling uses the new view. The view is set
+                # to the last 3000 points once, then slid along so its right side is on the latest point
+                if len(self.plot_x) > 3000:
+                    plot_x = self.plot_x.view()
+                    if not self.tracking:
+                        self.graphWidget.setXRange(plot_x[-3000], plot_x[-1], padding=0)
+                        self.tracking = True
+                    else:
+                        view_box = self.graphWidget.getViewBox()
+                        view_box.translateBy(x=plot_x[-1] - view_box.viewRange()[0][1])
+
+        # If the user is looking back at older data, the new data is off the chart and there is
+        # no point redrawing the raw line until the view changes
+        if self.view_changed or (self.raw_dirty and not self.new_data_off_view()):
+            plot_x, plot_y = self.visible_raw_data()
+            self.plotted_data.setData(plot_x, plot_y)
+            self.drawn_x_max = plot_x[-1] if len(plot_x) else None
+        self.raw_dirty = False
+        self.view_changed = False
+
+        if self.smooth_dirty:
             self.smoothed_plotted_data.setData(self.smooth_plot_x, self.smooth_plot_y)
+            self.smooth_dirty = False
 
-            # Reset the start time and the count back index
-            self.count_back = 0
-            self.st = None
-        else:
-            # count_back is used to get the index of the raw data
-            self.count_back = self.count_back + 1
-        
-        # Update the raw chart and display the latest signal value
-        self.plotted_data.setData(self.plot_x, self.plot_y)
-        self.signal_value.setText(f'Signal: {new_data[0]}')
+    def auto_track_toggled(self, checked):
+        """ Snaps the chart back to the latest data the next time Auto Track pans it along """
+        self.tracking = False
+
+    def chart_resized(self, view_box):
+        """ Caches the chart width in pixels and redraws the raw data at the new resolution """
+        self.chart_width = int(view_box.width())
+        self.view_changed = True
 
-        if self.autoscale_chart.isChecked():
-            # This will pan the chart along when there is enough data to do so
-            if len(self.plot_x) > 3000:
-                self.graphWidget.setXRange(self.plot_x[-3000], self.plot_x[-1])
+    def chart_view_changed(self, view_box, x_range):
+        self.view_x_max = x_range[1]
+        self.view_changed = True
+
+    def new_data_off_view(self):
+        """
+        True if the raw line already drawn runs past the right side of the view, which means 
+        any newer data would be off the chart. Never true while the chart is auto ranging
+        """
+        if self.graphWidget.getViewBox().autoRangeEnabled()[0]:
+            return False
+        if self.drawn_x_max is None or self.view_x_max is None:
+            return False
+        return self.drawn_x_max > self.view_x_max
+
+    def visible_raw_data(self):
+        """
+        Gets the raw data that is currently in view (all of it while the chart is auto ranging),
+        M4 downsampled to 4 points per pixel column if there is more than that to draw
+        """
+        plot_x, plot_y = self.raw_data_view()
+
+        view_box = self.graphWidget.getViewBox()
+        if not view_box.autoRangeEnabled()[0]:
+            # Keep one point either side of the view so the line runs off the edges of the chart
+            x_min, x_max = view_box.viewRange()[0]
+            start = max(np.searchsorted(plot_x, x_min) - 1, 0)
+            end = np.searchsorted(plot_x, x_max, side='right') + 1
+            plot_x, plot_y = plot_x[start:end], plot_y[start:end]
+
+        if self.chart_width > 0 and len(plot_x) > 4 * self.chart_width:
+            plot_x, plot_y = downsample_m4(plot_x, plot_y, self.chart_width)
+        return plot_x, plot_y
+
+    def raw_data_view(self):
+        """
+        Returns the raw x and y data held in the ring buffers in time order. These are 
+        views into the buffers, so nothing is copied
+        """
+        return self.plot_x.view(), self.plot_y.view()
 
 
 class DataAcquirer(QObject):
@@ -358,72 +612,266 @@ class DataAcquirer(QObject):
     The DataAcquirer class is created and used in a separate thread to capture data continually 
     from the serial device, it uses the PyQt signals and slots to communicate data back to the main UI thread
     """
-    new_data = pyqtSignal(list)
+    # new_data carries a float64 numpy array of shape (N, 2), a [value, time] row for each point
+    new_data = pyqtSignal(object)
     finished = pyqtSignal()
     
-    def __init__(self, serial_object, folder_path):
+    def __init__(self, serial_object, folder_path, period_ms):
         super().__init__()
-        self.measuring = True
+        # Set from the UI thread to stop the acquisition loop
+        self.stop_event = threading.Event()
         self.serial_object = serial_object
         self.folder_path = folder_path
 
-        self.file_path = folder_path + f"/FluoroAcq_{time.time()}.csv"
-        self.raw_data = []
-        self.raw_time_data = []
+        # The detector sends a count every gating period, so the time of each sample is 
+        # worked out from the start time and the sample number rather than the clock
+        self.period = period_ms / 1000
+        self.t0 = None
+        self.sample_index = 0
+
+        # The clock the sample times are checked against for drift (see clock_time), the wall clock 
+        # is read once and the high resolution counter is used from then on, time.time() only 
+        # ticks every ~15.6 ms on Windows which is a big chunk of the 100 ms period
+        self.t0_wall = None
+        self.t0_perf = None
+
+        # Save file named with the local start time down to the millisecond, e.g. 
+        # FluoroAcq_20240131T142501_123.csv
+        start = time.time()
+        file_name = time.strftime("FluoroAcq_%Y%m%dT%H%M%S", time.localtime(start)) + f"_{int(start % 1 * 1000):03d}.csv"
+        self.file_path = os.path.join(folder_path, file_name)
+
+        # Every value and time from the run, kept in numpy arrays that double in size when they
+        # fill up. Only the first raw_count points of each are actual data
+        self.raw_capacity = RAW_INITIAL_CAPACITY
+        self.raw_data = np.empty(self.raw_capacity, dtype=np.float64)
+        self.raw_time_data = np.empty(self.raw_capacity, dtype=np.float64)
+        self.raw_count = 0
+
+        # Holds bytes read from the serial port until a full 4 byte payload is available
+        self.read_buffer = bytearray()
+
+        # Points waiting to be sent to the UI thread and when they were last sent
+        self.batch = []
+        self.last_emit = time.monotonic()
+
+        # Lines waiting to be written to the save file
+        self.pending_lines = bytearray()
         
     def data_acquire_loop(self):
-        """ This is the main data acquisition loop - this will run while the class variable measuring is True"""
-        self.serial_object.write(b"C\r")
+        """ This is the main data acquisition loop - this will run until stop_event is set"""
+        self.serial_object.write(START_CMD)
         clear = self.serial_object.inWaiting()
         read = self.serial_object.read(size=4)
         #clear = self.ser.inWaiting()
-        while self.measuring:
-            f = open(self.file_path, "a")
-            print('Data acquire')
-                        
-            string_sent = self.serial_object.read(size=4)
-            #print(string_sent)
-            number = self.parse_byte_string(string_sent)
-
-            # If there is a decimal value from the payload (sometimes receive nothing)
-            if len(number) > 0:
-                
-                # Chop off the very last number - it doesn't seem relevant
-                number = float(str(number)[1:7])
-                print(number)
-
-                time_now = time.time()
-                # Append into the holder variables
-                self.raw_data.append(number)
-                self.raw_time_data.append(time_now)
-                results = [number, time_now]
-                self.new_data.emit(results)
+
+        self.t0_wall = time.time()
+        self.t0_perf = time.perf_counter_ns()
+        self.t0 = self.t0_wall
+        last_drift_check = time.monotonic()
+        drift_warned = 0
+        last_flush = time.monotonic()
+
+        # Open the save file once for the whole run, in binary mode with a 64 KB buffer. Lines are 
+        # collected and written in chunks, then flushed so they still make it to disk quickly
+        f = self.open_save_file()
+
+        # The setup reads above wait up to the port timeout for a full reply, the loop uses a
+        # short timeout instead so it notices a stop quickly. The port timeout is put back after
+        setup_timeout = self.serial_object.timeout
+        self.serial_object.timeout = LOOP_READ_TIMEOUT
+        try:
+            while not self.stop_event.is_set():
+                log.debug('Data acquire')
+
+                # Drain everything the OS has buffered in one read, if nothing is waiting yet
+                # this blocks until the next frame is complete (or the read times out)
+                waiting = self.serial_object.inWaiting()
+                frame_remainder = 4 - len(self.read_buffer) % 4
+                self.read_buffer.extend(self.serial_object.read(size=max(waiting, frame_remainder)))
+
+                # Stop was hit while waiting on the read, don't save anything that came in after it
+                if self.stop_event.is_set():
+                    break
+                #log.debug('%s', self.read_buffer)
+
+                # Work through every complete 4 byte payload, a partial payload (sometimes 
+                # receive less than 4 bytes) is kept in the buffer until the rest turns up
+                complete = len(self.read_buffer) - len(self.read_buffer) % 4
+                if complete:
+                    numbers = self.parse_payloads(self.read_buffer[:complete])
+                    del self.read_buffer[:complete]
+                    log.debug('%s', numbers)
+
+                    count = len(numbers)
+                    times = self.t0 + (self.sample_index + np.arange(1, count + 1)) * self.period
+                    self.sample_index = self.sample_index + count
+                    time_now = times[-1]
+
+                    # Append into the holder variables, making them bigger first if needed
+                    end = self.raw_count + count
+                    if end > self.raw_capacity:
+                        while end > self.raw_capacity:
+                            self.raw_capacity = self.raw_capacity * 2
+                        self.raw_data = np.resize(self.raw_data, self.raw_capacity)
+                        self.raw_time_data = np.resize(self.raw_time_data, self.raw_capacity)
+                    self.raw_data[self.raw_count:end] = numbers
+                    self.raw_time_data[self.raw_count:end] = times
+                    self.raw_count = end
+                    self.batch.append(np.column_stack((numbers, times)))
+
+                    # Queue up the lines for the save file, all joined in one go
+                    self.pending_lines += b"".join([CSV_LINE % sample for sample in zip(numbers.tolist(), times.tolist())])
+
                 # Write to the save file 
-                f.write(f'{number}, {time_now}\n')
+                if len(self.pending_lines) >= FLUSH_BYTES or (self.pending_lines and time.monotonic() - last_flush >= FLUSH_INTERVAL):
+                    self.write_pending(f)
+                    last_flush = time.monotonic()
+
+                # Once a second compare the sample time to the clock, in case samples are being dropped
+                # or the detector period is off. The saved times are worked out from the sample number, 
+                # so give a warning each time they get another whole period away from the clock
+                if complete and time.monotonic() - last_drift_check >= 1:
+                    drift = self.clock_time() - time_now
+                    log.debug('Timestamp drift: %.3f s', drift)
+                    drift_periods = int(abs(drift) / self.period)
+                    if drift_periods > drift_warned:
+                        log.warning('Sample times are %.3f s off the clock, samples may have been dropped', drift)
+                        drift_warned = drift_periods
+                    last_drift_check = time.monotonic()
+
+                # Only send data over to the UI thread at a capped rate, so it gets a handful 
+                # of points at once rather than a signal for every single point
+                if self.batch and time.monotonic() - self.last_emit >= EMIT_INTERVAL:
+                    self.emit_batch()
+
+            # Send across anything that was collected after the last update
+            if self.batch:
+                self.emit_batch()
+        finally:
+            self.write_pending(f)
+            f.close()
+            self.serial_object.timeout = setup_timeout
 
-        f.close()
         self.finished.emit()
 
-    def parse_byte_string(self, byte_string):
+    def clock_time(self):
+        """ Returns the current time in seconds since the epoch, from the high resolution counter """
+        return self.t0_wall + (time.perf_counter_ns() - self.t0_perf) / 1e9
+
+    def open_save_file(self):
+        """
+        Opens a new save file for the run. It is only ever created, never appended to, so if
+        a file with the same name is already there a number is added on the end instead
+        """
+        stem, ext = os.path.splitext(self.file_path)
+        file_path = self.file_path
+        suffix = 1
+        while True:
+            try:
+                f = open(file_path, "xb", buffering=65536)
+            except FileExistsError:
+                file_path = f"{stem}_{suffix}{ext}"
+                suffix = suffix + 1
+            else:
+                self.file_path = file_path
+                return f
+
+    def write_pending(self, f):
+        """ Writes the queued lines to the save file and flushes them to disk """
+        f.write(self.pending_lines)
+        f.flush()
+        self.pending_lines.clear()
+
+    def emit_batch(self):
+        """ Sends the collected [value, time] points to the UI thread as a numpy array and starts a new batch """
+        self.new_data.emit(np.concatenate(self.batch))
+        self.batch = []
+        self.last_emit = time.monotonic()
+
+    def parse_payloads(self, payloads):
         """
         This looks a little bit like some sort of black magic - I'm sorry - but it 
-        is essentially just cleaning up the 4 byte payload and converting it to a decimal
-        value. It is this way because there is leading zeros and the trailing length changes 
+        is essentially just cleaning up each 4 byte payload and converting it to a decimal
+        value. It is this way because there is leading zeros and the trailing length changes.
+        The digits of each (padded) byte are joined with integer maths rather than strings,
+        using the lookup tables at the top of the file, for every payload at once
         """
-        number = ''
-        for i, bit in enumerate(byte_string):
-            if i == 2:
-                if len(str(bit)) == 2:
-                    bit = '0' + str(bit)
-            if i == 3:
-                if len(str(bit)) == 2:
-                    bit = str(bit) + '0'
-                if len(str(bit)) == 1:
-                    bit = str(bit) + '00'
-            number = number + str(bit)
-        return number
+        b0, b1, b2, b3 = np.frombuffer(payloads, dtype=np.uint8).reshape(-1, 4).T
+
+        # Join all the digits together and work out how many digits there are
+        width = DIGIT_COUNT[b0] + DIGIT_COUNT[b1] + MID_BYTE_WIDTH[b2] + 3
+        number = ((b0 * POWERS_OF_TEN[DIGIT_COUNT[b1]] + b1) * POWERS_OF_TEN[MID_BYTE_WIDTH[b2]] + b2) * 1000 + LOW_BYTE_VALUE[b3]
+
+        # Drop the first digit and keep the next 6, chopping off the very last numbers - they 
+        # don't seem relevant
+        number = number % POWERS_OF_TEN[width - 1]
+        number = number // POWERS_OF_TEN[np.maximum(width - 7, 0)]
+        return number.astype(np.float64)
+
+
+class RingBuffer:
+    """
+    Fixed size buffer of numpy data, once it is full the oldest values get overwritten. The 
+    array is twice the size of the buffer and every value is written twice (at head and 
+    head + size), that way the newest values are always sitting in one contiguous slice 
+    and can be handed out as a view without copying or rolling the array
+    """
+    def __init__(self, size, dtype):
+        self.size = size
+        self.data = np.empty(size * 2, dtype=dtype)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, values):
+        """ Adds an array of values in one go, overwriting the oldest if the buffer is full """
+        index = (self.head + np.arange(len(values))) % self.size
+        self.data[index] = self.data[index + self.size] = values
+        self.head = (self.head + len(values)) % self.size
+        self.count = min(self.count + len(values), self.size)
+
+    def view(self):
+        """ Returns a view of the values held, oldest first """
+        end = self.head + self.size
+        return self.data[end - self.count:end]
+
+def window_median(window):
+    """
+    Median of a numpy array using np.partition (quickselect), which only partly sorts 
+    the data around the middle values rather than sorting the whole lot
+    """
+    middle = len(window) // 2
+    if len(window) % 2:
+        return np.partition(window, middle)[middle]
+    partitioned = np.partition(window, [middle - 1, middle])
+    return (partitioned[middle - 1] + partitioned[middle]) / 2
+
+def downsample_m4(x, y, n_bins):
+    """
+    M4 downsampling - splits the data into n_bins equal width columns along x and keeps just 
+    the first, min, max and last point of each column. Drawn with a column per pixel this looks 
+    the same as the full data set. The x data needs to be sorted
+    """
+    # Find the index of the first point in each column, empty columns are dropped
+    edges = np.linspace(x[0], x[-1], n_bins + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1]))
+    ends = np.append(starts[1:], len(x)) - 1
+
+    y_min = np.minimum.reduceat(y, starts)
+    y_max = np.maximum.reduceat(y, starts)
+
+    # Interleave the 4 points of each column back into a single line
+    m4_x = np.column_stack((x[starts], x[starts], x[ends], x[ends])).ravel()
+    m4_y = np.column_stack((y[starts], y_min, y_max, y[ends])).ravel()
+    return m4_x, m4_y
 
 def main():
+    # Debug output (every reading, serial replies) is off by default, set the level to 
+    # logging.DEBUG to see it
+    logging.basicConfig(level=logging.WARNING)
     app = QApplication(sys.argv)
     main = MainWindow()
     main.show()